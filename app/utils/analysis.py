@@ -1,6 +1,6 @@
 import os
 import json
-from typing import Any, Dict
+from typing import Any, Dict, List
 import openai
 
 OPENAI_API_KEY = (
@@ -15,10 +15,7 @@ if not OPENAI_API_KEY:
 
 client = openai.OpenAI(api_key=OPENAI_API_KEY)
 
-SYSTEM_QA = (
-    "You are an expert in electronic-assembly quality assurance and IPC-A-610F. "
-    "Analyse detected PCB defects and suggest corrective actions."
-)
+VECTOR_STORE_ID = "vs_689153891e14819198a310519b022630"
 
 TABLE_INSTRUCTIONS = (
     "For each defect provide: **reference**, **defect_type (IPC-A-610F)**, "
@@ -30,66 +27,41 @@ def _build_user_prompt(prediction_json: Dict[str, Any]) -> str:
     pretty = json.dumps(prediction_json, ensure_ascii=False, indent=2)
     return f"PCB defects (JSON):\n```json\n{pretty}\n```\n\n{TABLE_INSTRUCTIONS}"
 
-def _format_sources(results):
-    """Return XML-ish wrapper expected by the RAG prompt."""
-    formatted_results = ''
-    for result in results.data:
-        formatted_result = f"<result file_id='{result.file_id}' file_name='{result.file_name}'>"
-        for part in result.content:
-            formatted_result += f"<content>{part.text}</content>"
-        formatted_results += formatted_result + "</result>"
-    return f"<sources>{formatted_results}</sources>"
-
-def analyse_defects_with_chat(prediction_json: dict) -> str:
-    """
-    One-shot GPT call (no retrieval) that returns a Markdown table.
-    """
+def _cited_files(response) -> List[str]:
+    """File names cited by the file_search tool, in order of first citation."""
+    names = []
+    for item in response.output:
+        if item.type != "message":
+            continue
+        for part in item.content:
+            for annotation in getattr(part, "annotations", None) or []:
+                if annotation.type == "file_citation" and annotation.filename not in names:
+                    names.append(annotation.filename)
+    return names
 
-    if not prediction_json:
-        raise ValueError("prediction_json is empty")
-    
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": SYSTEM_QA},
-            {"role": "user",   "content": _build_user_prompt(prediction_json)},
-        ],
-        temperature=0.2,
-        max_tokens=600,
-    )
-    return response.choices[0].message.content.strip()
-    
 def analyse_defects_with_rag(prediction_json: dict) -> str:
     """
     GPT call **with** vector-store retrieval (RAG).
-    Returns Markdown table enriched with citations.
+    Retrieval and generation happen server-side in a single Responses API
+    call through the `file_search` tool.
+    Returns Markdown table followed by the names of the cited source files.
     """
     
     if not prediction_json:
         raise ValueError("prediction_json is empty")
 
-    
-    query = _build_user_prompt(prediction_json)
-
-    results = client.vector_stores.search(
-        vector_store_id='vs_689153891e14819198a310519b022630',
-        query=query
-    )
-
-    formatted_results = ''
-    for result in results.data:
-        formatted_result = f"<result file_id='{result.file_id}' file_name='{result.filename}'>"
-        for part in result.content:
-            formatted_result += f"<content>{part.text}</content>"
-        formatted_results += formatted_result + "</result>"
-    formatted_results = f"<sources>{formatted_results}</sources>"
-    
-    completion = client.chat.completions.create(
+    response = client.responses.create(
         model="gpt-4o-mini",
-        messages=[
-            {"role": "system",    "content": "Produce a concise answer to the query based on the provided sources."},
-            {"role": "assistant", "content": formatted_results},
-            {"role": "user",      "content": query},
-        ]
+        instructions=(
+            "Produce a concise answer to the query based on the IPC-A-610F "
+            "excerpts returned by the file_search tool."
+        ),
+        input=_build_user_prompt(prediction_json),
+        tools=[{"type": "file_search", "vector_store_ids": [VECTOR_STORE_ID]}],
+        max_output_tokens=600,
     )
-    return completion.choices[0].message.content.strip()
\ No newline at end of file
+    answer = response.output_text.strip()
+    sources = _cited_files(response)
+    if sources:
+        answer += "\n\n**Sources:** " + ", ".join(sources)
+    return answer
@@ -1,43 +1,329 @@
 import io
-from typing import Tuple, List, Dict, Any
+import os
+import hashlib
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import lru_cache
+from typing import Tuple, List, Dict, Any, Optional
 from ultralytics import YOLO
-from PIL import Image, ImageDraw, ImageFont
 import numpy as np
+import torch
+import cv2
 
-model = YOLO('app/utils/best.pt')
+def _env_choice(name: str, default: str, choices: Tuple[str, ...]) -> str:
+    """Read an enumerated setting, rejecting typos at import instead of silently ignoring them."""
+    value = os.getenv(name, default).lower()
+    if value not in choices:
+        raise RuntimeError(f"{name}={value!r} is not one of: {', '.join(choices)}")
+    return value
 
-def detect_and_annotate(image_file: io.BytesIO) -> Tuple[List[Dict[str, Any]], io.BytesIO]:
-    pil_img = Image.open(image_file).convert("RGB")
-    img_np = np.array(pil_img)
-    #results = model.predict(source=img_np, save=False, verbose=False, device='mps')
-    results = model.predict(source=img_np, save=False, verbose=False)
-    det = results[0]
+MODEL_PATH = os.getenv("PCB_MODEL_PATH", "app/utils/best.pt")
+# "torch" | "onnx"; onnx runs an exported best.onnx through onnxruntime (CPU deployments)
+BACKEND = _env_choice("PCB_BACKEND", "torch", ("torch", "onnx"))
+# "fp32" | "fp16" | "int8"; fp16/int8 prefer TensorRT engines exported next to the weights
+PRECISION = _env_choice("PCB_PRECISION", "fp32", ("fp32", "fp16", "int8"))
+# e.g. "cpu", "0", "cuda:0", "mps"; None lets ultralytics pick
+DEVICE = os.getenv("PCB_DEVICE") or None
+# detections cached per image content; 0 disables the cache
+CACHE_SIZE = int(os.getenv("PCB_CACHE_SIZE", "256"))
+# uploads whose longer side exceeds this are downscaled before inference; 0 disables
+MAX_IMAGE_SIDE = int(os.getenv("PCB_MAX_IMAGE_SIDE", "1280"))
+# "png" (lossless) | "webp" (faster to encode, smaller, lossy)
+ANNOTATION_FORMAT = _env_choice("PCB_ANNOTATION_FORMAT", "png", ("png", "webp"))
+# concurrent sessions' images are coalesced into one forward pass of up to
+# PCB_MAX_BATCH_SIZE images, waiting at most PCB_MAX_BATCH_WAIT_MS for company
+MAX_BATCH_SIZE = int(os.getenv("PCB_MAX_BATCH_SIZE", "8"))
+MAX_BATCH_WAIT = int(os.getenv("PCB_MAX_BATCH_WAIT_MS", "20")) / 1000
+# hand cached CUDA blocks back to the driver every N predict calls; 0 disables
+EMPTY_CACHE_EVERY = int(os.getenv("PCB_EMPTY_CACHE_EVERY", "32"))
 
+# extensions offered by the uploader; immutable so callers can't widen it at runtime
+ALLOWED_EXTENSIONS = ("png", "jpg", "jpeg")
+
+# file signatures of the formats we accept, checked before any decoding
+MAGIC_TO_MIME = {
+    b"\xff\xd8\xff": "image/jpeg",
+    b"\x89PNG\r\n\x1a\n": "image/png",
+    b"BM": "image/bmp",
+    b"II*\x00": "image/tiff",
+    b"MM\x00*": "image/tiff",
+}
+
+def sniff_mime(buf: memoryview) -> Optional[str]:
+    """Return the image MIME type from the leading magic bytes, or None."""
+    header = bytes(buf[:16])
+    for magic, mime in MAGIC_TO_MIME.items():
+        if header.startswith(magic):
+            return mime
+    return None
+
+_cache: "OrderedDict[bytes, List[Dict[str, Any]]]" = OrderedDict()
+_cache_lock = threading.Lock()
+# bumped on every model (re)load; detections from an older model are never cached
+_cache_generation = 0
+
+def _copy_detections(detections: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [dict(d, box=list(d["box"])) for d in detections]
+
+# the cache keeps its own copy and hands out copies, so callers mutating the
+# returned detections can't change what other sessions get on a cache hit
+def _cache_get(key: bytes) -> Optional[List[Dict[str, Any]]]:
+    with _cache_lock:
+        detections = _cache.get(key)
+        if detections is None:
+            return None
+        _cache.move_to_end(key)
+    return _copy_detections(detections)
+
+def _cache_put(key: bytes, detections: List[Dict[str, Any]], generation: int) -> None:
+    if CACHE_SIZE <= 0:
+        return
+    with _cache_lock:
+        if generation != _cache_generation:
+            return
+        _cache[key] = _copy_detections(detections)
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+def _resolve_weights() -> str:
+    stem = os.path.splitext(MODEL_PATH)[0]
+    candidates = []
+    if BACKEND == "onnx":
+        candidates = [stem + ".onnx"]
+    elif PRECISION == "int8":
+        # fall back to the fp16 engine when no calibrated engine was exported
+        candidates = [stem + "_int8.engine", stem + ".engine"]
+    elif PRECISION == "fp16":
+        candidates = [stem + ".engine"]
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    return MODEL_PATH
+
+def _extract(model: YOLO, det) -> List[Dict[str, Any]]:
+    if det.boxes is None:
+        return []
+    # one device->host copy per tensor instead of three per box; rounded
+    # (in float64, so no float32 noise) as detections end up in the LLM prompt
+    xyxy = det.boxes.xyxy.cpu().numpy().astype(np.float64).round(1).tolist()
+    confs = det.boxes.conf.cpu().numpy().astype(np.float64).round(4).tolist()
+    classes = det.boxes.cls.cpu().numpy().astype(int).tolist()
+    names = model.names
+    return [
+        {"class": names[cls_id], "confidence": conf, "box": box}
+        for box, conf, cls_id in zip(xyxy, confs, classes)
+    ]
+
+def _is_exported(model: YOLO) -> bool:
+    # exported models (TensorRT engines, ONNX) are built with a fixed batch
+    # of 1; ultralytics only holds an nn.Module for .pt checkpoints,
+    # exported ones are kept as a path
+    return not isinstance(model.model, torch.nn.Module)
+
+def _run(model: YOLO, images: List[np.ndarray]) -> List[List[Dict[str, Any]]]:
+    """
+    Detections for each image. Results are streamed and reduced to plain
+    dicts one by one, so their tensors are released as we go.
+    """
+    # fixed-batch exports are fed one image at a time
+    batches = [[img] for img in images] if _is_exported(model) else [images]
     detections = []
-    draw = ImageDraw.Draw(pil_img)
-    font = ImageFont.load_default()
-    if det.boxes is not None:
-        for box in det.boxes:
-            x1, y1, x2, y2 = box.xyxy[0].tolist()
-            conf = float(box.conf[0])
-            cls_id = int(box.cls[0])
-            cls_name = model.names[cls_id]
-            label = f"{cls_name} {conf:.2f}"
-
-            detections.append({
-                "class": cls_name,
-                "confidence": conf,
-                "box": [x1, y1, x2, y2]
-            })
-
-            draw.rectangle([x1, y1, x2, y2], outline="red", width=2)
-            bbox = draw.textbbox((x1, y1), label, font=font)
-            text_w = bbox[2] - bbox[0]
-            text_h = bbox[3] - bbox[1]
-            draw.rectangle([x1, y1 - text_h, x1 + text_w, y1], fill="red")
-            draw.text((x1, y1 - text_h), label, fill="white", font=font)
-
-    buf = io.BytesIO()
-    pil_img.save(buf, format="PNG")
-    buf.seek(0)
-    return detections, buf
\ No newline at end of file
+    for batch in batches:
+        # ultralytics expects ndarrays in OpenCV's BGR order
+        results = model.predict(
+            source=batch, save=False, verbose=False, stream=True,
+            device=DEVICE, half=PRECISION == "fp16",
+        )
+        detections.extend(_extract(model, det) for det in results)
+    return detections
+
+def warmup(model: YOLO, runs: int = 2) -> None:
+    """
+    Run dummy forward passes so the first real request doesn't pay for CUDA
+    context creation, kernel loading or TensorRT engine deserialization.
+    """
+    dummy = np.zeros((640, 640, 3), dtype=np.uint8)
+    for _ in range(runs):
+        _run(model, [dummy])
+
+@lru_cache(maxsize=1)
+def get_model() -> YOLO:
+    """
+    The only place weights are loaded. Call get_model.cache_clear() to
+    reload; cached detections from the previous model are dropped, and
+    results still in flight from it are refused by _cache_put.
+    """
+    global _cache_generation
+    model = YOLO(_resolve_weights())
+    warmup(model)
+    with _cache_lock:
+        _cache.clear()
+        _cache_generation += 1
+    return model
+
+# load and warm up at import; the import lock keeps this to one load per process
+get_model()
+
+# Streamlit runs every session in its own thread; the shared ultralytics
+# predictor is not thread-safe, so forward passes are serialized.
+_predict_lock = threading.Lock()
+_predict_calls = 0
+
+def _predict(images: List[np.ndarray]) -> Tuple[int, List[List[Dict[str, Any]]]]:
+    """Detections for `images`, tagged with the generation of the model that produced them."""
+    global _predict_calls
+    with _predict_lock:
+        # get_model() may reload and bump the generation, so read it afterwards
+        model = get_model()
+        generation = _cache_generation
+        detections = _run(model, images)
+
+        _predict_calls += 1
+        if EMPTY_CACHE_EVERY > 0 and _predict_calls % EMPTY_CACHE_EVERY == 0 and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    return generation, detections
+
+_batch_queue: "queue.Queue[Tuple[np.ndarray, Future]]" = queue.Queue()
+
+def _collect_batch() -> List[Tuple[np.ndarray, Future]]:
+    """Block for one request, then gather more until the batch is full or the wait runs out."""
+    batch = [_batch_queue.get()]
+    if _is_exported(get_model()):
+        # _run() would split the batch again, so waiting only adds latency
+        return batch
+    deadline = time.monotonic() + MAX_BATCH_WAIT
+    while len(batch) < MAX_BATCH_SIZE:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(_batch_queue.get(timeout=timeout))
+        except queue.Empty:
+            break
+    return batch
+
+def _batch_worker() -> None:
+    while True:
+        batch = _collect_batch()
+        futures = [future for _, future in batch]
+        try:
+            generation, results = _predict([img for img, _ in batch])
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+        else:
+            for future, detections in zip(futures, results):
+                future.set_result((generation, detections))
+
+threading.Thread(target=_batch_worker, name="pcb-batcher", daemon=True).start()
+
+def _infer(images: List[np.ndarray]) -> List[Tuple[int, List[Dict[str, Any]]]]:
+    """
+    Queue images for the batch worker and wait for their (model generation,
+    detections). Images from concurrent Streamlit sessions share a forward pass.
+    """
+    futures = []
+    for img in images:
+        future: Future = Future()
+        _batch_queue.put((img, future))
+        futures.append(future)
+    return [future.result() for future in futures]
+
+def _read_buffer(image_file: io.BytesIO) -> memoryview:
+    """Zero-copy view of an in-memory upload; falls back to read() for other file objects."""
+    getbuffer = getattr(image_file, "getbuffer", None)
+    if getbuffer is not None:
+        return getbuffer()
+    return memoryview(image_file.read())
+
+def _decode(buf: memoryview) -> np.ndarray:
+    """Decode an in-memory upload straight to a BGR ndarray."""
+    bgr = cv2.imdecode(np.frombuffer(buf, np.uint8), cv2.IMREAD_COLOR)
+    if bgr is None:
+        raise ValueError("Could not decode the uploaded image")
+    return bgr
+
+def _downscale(img: np.ndarray) -> Tuple[np.ndarray, float]:
+    """Shrink oversized images once, up front; returns the image and the scale applied."""
+    h, w = img.shape[:2]
+    if MAX_IMAGE_SIDE <= 0 or max(h, w) <= MAX_IMAGE_SIDE:
+        return img, 1.0
+    scale = MAX_IMAGE_SIDE / max(h, w)
+    return cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA), scale
+
+def _rescale(detections: List[Dict[str, Any]], factor: float) -> List[Dict[str, Any]]:
+    return [{**d, "box": [round(v * factor, 1) for v in d["box"]]} for d in detections]
+
+_ENCODE_PARAMS = {
+    # level 1 deflate: much faster than the default, slightly larger output
+    "png": [cv2.IMWRITE_PNG_COMPRESSION, 1],
+    "webp": [cv2.IMWRITE_WEBP_QUALITY, 85],
+}
+
+def _draw(img: np.ndarray, detections: List[Dict[str, Any]], scale: float, image_format: str) -> io.BytesIO:
+    """
+    Draw boxes in place on a BGR ndarray and return it encoded as `image_format`.
+    Boxes are in original-image coordinates; `scale` maps them onto `img`.
+    """
+    for d in detections:
+        x1, y1, x2, y2 = (int(round(v * scale)) for v in d["box"])
+        label = f"{d['class']} {d['confidence']:.2f}"
+
+        cv2.rectangle(img, (x1, y1), (x2, y2), (0, 0, 255), 2)
+        (text_w, text_h), baseline = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)
+        cv2.rectangle(img, (x1, y1 - text_h - baseline), (x1 + text_w, y1), (0, 0, 255), cv2.FILLED)
+        cv2.putText(img, label, (x1, y1 - baseline), cv2.FONT_HERSHEY_SIMPLEX, 0.5,
+                    (255, 255, 255), 1, cv2.LINE_AA)
+
+    ok, encoded = cv2.imencode(f".{image_format}", img, _ENCODE_PARAMS[image_format])
+    if not ok:
+        raise RuntimeError("Could not encode the annotated image")
+    return io.BytesIO(encoded.tobytes())
+
+def detect_and_annotate_batch(
+    image_files: List[io.BytesIO], image_format: str = ANNOTATION_FORMAT
+) -> List[Tuple[List[Dict[str, Any]], io.BytesIO]]:
+    """
+    Detect and annotate several images; uncached ones go to the batch
+    worker together, alongside those of any concurrent sessions.
+    Images seen before (same bytes) are served from the result cache and
+    skip inference entirely; only their annotation is redrawn.
+    Oversized images are downscaled first (see PCB_MAX_IMAGE_SIDE), so the
+    annotated image may be smaller than the upload, but the returned boxes
+    are always in the upload's original pixel coordinates.
+    """
+    if image_format not in _ENCODE_PARAMS:
+        raise ValueError(f"Unsupported annotation format: {image_format}")
+
+    bufs = [_read_buffer(f) for f in image_files]
+    for f, buf in zip(image_files, bufs):
+        if sniff_mime(buf) is None:
+            name = getattr(f, "name", "upload")
+            raise ValueError(f"{name} is not a JPEG, PNG, BMP or TIFF image")
+    keys = [hashlib.blake2b(buf, digest_size=16).digest() for buf in bufs]
+    decoded = [_downscale(_decode(buf)) for buf in bufs]
+    images = [img for img, _ in decoded]
+    scales = [scale for _, scale in decoded]
+
+    detections = [_cache_get(key) for key in keys]
+    misses = [i for i, d in enumerate(detections) if d is None]
+    if misses:
+        for i, (generation, dets) in zip(misses, _infer([images[i] for i in misses])):
+            if scales[i] != 1.0:
+                dets = _rescale(dets, 1 / scales[i])
+            detections[i] = dets
+            _cache_put(keys[i], dets, generation)
+
+    return [
+        (dets, _draw(img, dets, scale, image_format))
+        for img, scale, dets in zip(images, scales, detections)
+    ]
+
+def detect_and_annotate(
+    image_file: io.BytesIO, image_format: str = ANNOTATION_FORMAT
+) -> Tuple[List[Dict[str, Any]], io.BytesIO]:
+    return detect_and_annotate_batch([image_file], image_format)[0]
@@ -2,7 +2,7 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import streamlit as st
-from app.utils.detection import detect_and_annotate
+from app.utils.detection import ALLOWED_EXTENSIONS, detect_and_annotate
 from app.utils.analysis import analyse_defects_with_rag
 
 
@@ -13,7 +13,7 @@ def main():
     with st.form("upload_form"):
         uploaded_file = st.file_uploader(
             "Pick a PCB Image",
-            type=["png", "jpg", "jpeg"]
+            type=ALLOWED_EXTENSIONS
         )
         submitted = st.form_submit_button("Start detection")
 
@@ -21,7 +21,11 @@ def main():
         if not uploaded_file:
             st.warning("❗ Choose an image")
         else:
-            detections, annotated_buf = detect_and_annotate(uploaded_file)
+            try:
+                detections, annotated_buf = detect_and_annotate(uploaded_file)
+            except ValueError as e:
+                st.error(f"❗ {e}")
+                return
             if  detections:
                 with st.spinner("Analyzing PCB defects..."):
                         print(detections)
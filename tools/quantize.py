@@ -0,0 +1,41 @@
+"""
+Export the PCB YOLO model to an INT8 TensorRT engine.
+
+Creates exactly one file, `<weights stem>_int8.engine` next to the weights
+(app/utils/best_int8.engine by default). The export runs on a copy of the
+weights in a temporary directory, so the intermediate ONNX file and the
+engine ultralytics writes there never touch the fp16 best.engine or the
+best.onnx used by PCB_BACKEND=onnx.
+
+Calibration runs on the images listed in a YOLO dataset YAML (PCB_CALIB_DATA);
+~200 representative PCB photos covering every defect class is enough.
+ultralytics uses TensorRT's entropy calibrator, which picks per-tensor
+activation ranges from histograms rather than raw min/max. Defect classes
+with sparse activations (rare defects) are therefore only clipped well if
+they actually appear in the calibration set, so keep them represented.
+"""
+import os
+import shutil
+import tempfile
+from ultralytics import YOLO
+
+MODEL_PATH = os.getenv("PCB_MODEL_PATH", "app/utils/best.pt")
+CALIB_DATA = os.getenv("PCB_CALIB_DATA", "calib.yaml")
+
+int8_path = os.path.splitext(MODEL_PATH)[0] + "_int8.engine"
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    tmp_weights = os.path.join(tmp_dir, os.path.basename(MODEL_PATH))
+    shutil.copy(MODEL_PATH, tmp_weights)
+
+    model = YOLO(tmp_weights)
+    engine_path = model.export(
+        format="engine",
+        int8=True,
+        data=CALIB_DATA,
+        imgsz=640,
+        device=0,
+    )
+    shutil.move(engine_path, int8_path)
+
+print(f'int8 engine={int8_path}')